@@ -18,11 +18,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
 import logging
 import os.path
 import socket
 import threading
 import time
+import weakref
 
 import six
 
@@ -30,6 +32,18 @@ from .src import event_pb2
 from .record_writer import RecordWriter
 
 
+# Writers that are still open. They are closed at exit, while the daemon
+# logger threads still run, so that buffered events are not lost when a
+# writer is never closed.
+_open_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_writers():
+    for writer in list(_open_writers):
+        writer.close()
+
+
 def directory_check(path):
     '''Initialize the directory for log files.'''
     # If the direcotry does not exist, create it!
@@ -40,20 +54,26 @@ def directory_check(path):
 class EventsWriter(object):
     '''Writes `Event` protocol buffers to an event file.'''
 
-    def __init__(self, file_prefix):
+    def __init__(self, file_prefix, buffer_size=65536):
         '''
         Events files have a name of the form
         '/some/file/path/events.out.tfevents.[timestamp].[hostname]'
         '''
         self._file_prefix = file_prefix + ".out.tfevents." \
                             + str(time.time())[:10] + "." + socket.gethostname()
+        # Do not truncate a file from a writer reopened within the same second.
+        base, i = self._file_prefix, 0
+        while os.path.exists(self._file_prefix):
+            i += 1
+            self._file_prefix = base + "." + str(i)
 
         # Open(Create) the log file with the particular form of name.
         logging.basicConfig(filename=self._file_prefix)
 
         self._num_outstanding_events = 0
 
-        self._py_recordio_writer = RecordWriter(self._file_prefix)
+        self._py_recordio_writer = RecordWriter(self._file_prefix,
+                                                buffer_size=buffer_size)
 
         # Initialize an event instance.
         self._event = event_pb2.Event()
@@ -61,6 +81,7 @@ class EventsWriter(object):
         self._event.wall_time = time.time()
 
         self.write_event(self._event)
+        self.flush()
 
     def write_event(self, event):
         '''Append "event" to the file.'''
@@ -69,20 +90,23 @@ class EventsWriter(object):
         if not isinstance(event, event_pb2.Event):
             raise TypeError("Expected an event_pb2.Event proto, "
                             " but got %s" % type(event))
-        return self._write_serialized_event(event.SerializeToString())
+        return self.write_serialized_event(event.SerializeToString())
 
-    def _write_serialized_event(self, event_str):
+    def write_serialized_event(self, event_str):
+        '''Append an already serialized `Event` to the file.'''
         self._num_outstanding_events += 1
         self._py_recordio_writer.write(event_str)
 
     def flush(self):
         '''Flushes the event file to disk.'''
+        self._py_recordio_writer.flush()
         self._num_outstanding_events = 0
         return True
 
     def close(self):
-        '''Call self.flush().'''
+        '''Flushes the event file and closes it.'''
         return_value = self.flush()
+        self._py_recordio_writer.close()
         return return_value
 
 
@@ -93,11 +117,12 @@ class EventFileWriter(object):
     is encoded using the tfrecord format, which is similar to RecordIO.
     @@__init__
     @@add_event
+    @@add_event_bytes
     @@flush
     @@close
     """
 
-    def __init__(self, logdir, max_queue=10, flush_secs=120):
+    def __init__(self, logdir, max_queue=10, flush_secs=120, buffer_size=65536):
         """Creates a `EventFileWriter` and an event file to write to.
         On construction the summary writer creates a new event file in `logdir`.
         This event file will contain `Event` protocol buffers, which are written to
@@ -108,21 +133,31 @@ class EventFileWriter(object):
            and events to disk.
         *  `max_queue`: Maximum number of summaries or events pending to be
            written to disk before one of the 'add' calls block.
+        *  `buffer_size`: Size in bytes of the file buffer in which written
+           events are batched until the next flush.
         Args:
           logdir: A string. Directory where event file will be written.
           max_queue: Integer. Size of the queue for pending events and summaries.
           flush_secs: Number. How often, in seconds, to flush the
             pending events and summaries to disk.
+          buffer_size: Integer. Size in bytes of the event file buffer.
         """
         self._logdir = logdir
         directory_check(self._logdir)
         self._event_queue = six.moves.queue.Queue(max_queue)
-        self._ev_writer = EventsWriter(os.path.join(self._logdir, "events"))
-        self._closed = False
-        self._worker = _EventLoggerThread(self._event_queue, self._ev_writer,
-                                          flush_secs)
+        self._flush_secs = flush_secs
+        self._buffer_size = buffer_size
+        self._closed = True
+        self._open()
 
+    def _open(self):
+        self._ev_writer = EventsWriter(os.path.join(self._logdir, "events"),
+                                       self._buffer_size)
+        self._worker = _EventLoggerThread(self._event_queue, self._ev_writer,
+                                          self._flush_secs)
         self._worker.start()
+        self._closed = False
+        _open_writers.add(self)
 
     def get_logdir(self):
         """Returns the directory where event file will be written."""
@@ -135,21 +170,37 @@ class EventFileWriter(object):
         Does nothing if the EventFileWriter was not closed.
         """
         if self._closed:
-            self._closed = False
+            self._open()
 
     def add_event(self, event):
         """Adds an event to the event file.
+        The event is serialized before this method returns, so the caller is
+        free to modify or reuse it afterwards.
         Args:
           event: An `Event` protocol buffer.
         """
+        if not isinstance(event, event_pb2.Event):
+            raise TypeError("Expected an event_pb2.Event proto, "
+                            " but got %s" % type(event))
+        self.add_event_bytes(event.SerializeToString())
+
+    def add_event_bytes(self, event_str):
+        """Adds a serialized event to the event file.
+        The writer thread only frames and writes the bytes; no protobuf work
+        is done off the calling thread.
+        Args:
+          event_str: An `Event` protocol buffer serialized as a string.
+        """
         if not self._closed:
-            self._event_queue.put(event)
+            self._event_queue.put(event_str)
 
     def flush(self):
         """Flushes the event file to disk.
         Call this method to make sure that all pending events have been written to
         disk.
         """
+        if self._closed:
+            return
         self._event_queue.join()
         self._ev_writer.flush()
 
@@ -157,9 +208,15 @@ class EventFileWriter(object):
         """Flushes the event file to disk and close the file.
         Call this method when you do not need the summary writer anymore.
         """
-        self.flush()
-        self._ev_writer.close()
+        if self._closed:
+            return
         self._closed = True
+        _open_writers.discard(self)
+        self._worker.stop()
+        self._ev_writer.close()
+
+
+_STOP = object()
 
 
 class _EventLoggerThread(threading.Thread):
@@ -168,30 +225,51 @@ class _EventLoggerThread(threading.Thread):
     def __init__(self, queue, ev_writer, flush_secs):
         """Creates an _EventLoggerThread.
         Args:
-          queue: A Queue from which to dequeue events.
+          queue: A Queue from which to dequeue serialized events.
           ev_writer: An event writer. Used to log brain events for
            the visualizer.
           flush_secs: How often, in seconds, to flush the
-            pending file to disk.
+            pending file to disk. Events are never left unflushed for longer,
+            even if no further events arrive.
         """
         threading.Thread.__init__(self)
         self.daemon = True
         self._queue = queue
         self._ev_writer = ev_writer
         self._flush_secs = flush_secs
-        # The first event will be flushed immediately.
+        # The file version event is flushed on construction, and the first
+        # event will be flushed immediately.
+        self._pending = False
         self._next_event_flush_time = 0
 
     def run(self):
         while True:
-            event = self._queue.get()
+            if self._pending:
+                # Wake up at the flush deadline even if no event comes in.
+                timeout = max(self._next_event_flush_time - time.time(), 0)
+                try:
+                    event_str = self._queue.get(timeout=timeout)
+                except six.moves.queue.Empty:
+                    self._flush()
+                    continue
+            else:
+                event_str = self._queue.get()
             try:
-                self._ev_writer.write_event(event)
-                # Flush the event writer every so often.
-                now = time.time()
-                if now > self._next_event_flush_time:
-                    self._ev_writer.flush()
-                    # Do it again in two minutes.
-                    self._next_event_flush_time = now + self._flush_secs
+                if event_str is _STOP:
+                    return
+                self._ev_writer.write_serialized_event(event_str)
+                self._pending = True
+                if time.time() > self._next_event_flush_time:
+                    self._flush()
             finally:
                 self._queue.task_done()
+
+    def _flush(self):
+        self._ev_writer.flush()
+        self._pending = False
+        self._next_event_flush_time = time.time() + self._flush_secs
+
+    def stop(self):
+        """Writes the queued events, then stops the thread."""
+        self._queue.put(_STOP)
+        self.join()
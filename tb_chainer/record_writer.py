@@ -13,26 +13,35 @@ _VALID_OP_NAME_PART = re.compile('[A-Za-z0-9_.\\-/]+')
 
 
 class RecordWriter(object):
-    def __init__(self, path, flush_secs=2):
+    def __init__(self, path, flush_secs=None, buffer_size=65536):
+        # `flush_secs` is accepted for backward compatibility only. Records
+        # are batched in the file buffer and only reach the disk when it
+        # fills up or the owner calls flush(), which EventFileWriter does
+        # on its own flush_secs schedule.
         self._name_to_tf_name = {}
         self._tf_names = set()
         self.path = path
-        self.flush_secs = flush_secs  # TODO. flush every flush_secs, not every time.
         self._writer = None
-        self._writer = open(path, 'wb')
+        self._writer = open(path, 'wb', buffer_size)
 
     def write(self, event_str):
-        w = self._writer.write
         header = struct.pack('Q', len(event_str))
-        w(header)
-        w(struct.pack('I', masked_crc32c(header)))
-        w(event_str)
-        w(struct.pack('I', masked_crc32c(event_str)))
+        self._writer.write(b''.join([
+            header,
+            struct.pack('I', masked_crc32c(header)),
+            event_str,
+            struct.pack('I', masked_crc32c(event_str))]))
+
+    def flush(self):
         self._writer.flush()
 
-    def __del__(self):
+    def close(self):
         if self._writer is not None:
             self._writer.close()
+            self._writer = None
+
+    def __del__(self):
+        self.close()
 
 
 def masked_crc32c(data):
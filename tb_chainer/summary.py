@@ -54,6 +54,9 @@ from .src.tensor_shape_pb2 import TensorShapeProto
 
 _INVALID_TAG_CHARACTERS = _re.compile(r'[^-/\w\.]')
 
+# (bins, HistogramProto) pairs keyed by id(bins), see _histogram_template().
+_histogram_templates = {}
+
 
 def _clean_tag(name):
   # In the past, the first argument to summary ops was a tag, which allowed
@@ -95,7 +98,7 @@ def scalar(name, scalar, collections=None):
     return Summary(value=[Summary.Value(tag=name, simple_value=scalar)])
 
 
-def histogram(name, values, bins, collections=None):
+def histogram(name, values, bins, collections=None, sorted_bins=False):
     # pylint: disable=line-too-long
     """Outputs a `Summary` protocol buffer with a histogram.
     The generated
@@ -107,32 +110,80 @@ def histogram(name, values, bins, collections=None):
         TensorBoard.
       values: A real numeric `Tensor`. Any shape. Values to use to
         build the histogram.
+      bins: Bin edges, or any other `bins` argument accepted by `np.histogram`.
       collections: Optional list of graph collections keys. The new summary op is
         added to these collections. Defaults to `[GraphKeys.SUMMARIES]`.
+      sorted_bins: If True, `bins` is a 1-D array of increasing edges and the
+        histogram is computed by `_bucketize` instead of `np.histogram`.
     Returns:
       A scalar `Tensor` of type `string`. The serialized `Summary` protocol
       buffer.
     """
     name = _clean_tag(name)
-    hist = make_histogram(values.astype(float), bins)
+    if values.dtype != np.float32:
+        values = values.astype(float)
+    hist = make_histogram(values, bins, sorted_bins)
     return Summary(value=[Summary.Value(tag=name, histo=hist)])
 
 
 
-def make_histogram(values, bins):
+def make_histogram(values, bins, sorted_bins=False):
     """Convert values into a histogram proto using logic from histogram.cc."""
     values = values.reshape(-1)
-    counts, limits = np.histogram(values, bins=bins)
-    limits = limits[1:]
-
-    sum_sq = values.dot(values)
-    return HistogramProto(min=values.min(),
-                          max=values.max(),
-                          num=len(values),
-                          sum=values.sum(),
-                          sum_squares=sum_sq,
-                          bucket_limit=limits,
-                          bucket=counts)
+    if sorted_bins:
+        counts, values = _bucketize(values, bins)
+        if values.size and not np.isnan(values[-1]):
+            # The extremes come for free from the sorted values.
+            min_, max_ = values[0], values[-1]
+        else:
+            # NaN sorts last but makes both extremes NaN, as below; and
+            # empty values raise the same ValueError as below.
+            min_, max_ = values.min(), values.max()
+        hist = HistogramProto()
+        hist.CopyFrom(_histogram_template(bins))
+    else:
+        counts, limits = np.histogram(values, bins=bins)
+        min_, max_ = values.min(), values.max()
+        # Plain lists convert much faster than ndarrays.
+        hist = HistogramProto(bucket_limit=limits[1:].tolist())
+    hist.bucket.extend(counts.tolist())
+
+    hist.min = min_
+    hist.max = max_
+    hist.num = len(values)
+    # Accumulate the moments in float64 even for float32 values.
+    hist.sum = values.sum(dtype=np.float64)
+    hist.sum_squares = np.einsum('i,i', values, values, dtype=np.float64)
+    return hist
+
+
+def _histogram_template(bins):
+    """Returns a `HistogramProto` holding only the bucket limits of `bins`.
+    Histograms against the default bins are taken with the same array on
+    every call, so its limits are converted to a proto once and copied into
+    each histogram afterwards.
+    """
+    entry = _histogram_templates.get(id(bins))
+    if entry is None or entry[0] is not bins:
+        if len(_histogram_templates) >= 16:
+            _histogram_templates.clear()
+        entry = (bins, HistogramProto(bucket_limit=bins[1:].tolist()))
+        _histogram_templates[id(bins)] = entry
+    return entry[1]
+
+
+def _bucketize(values, bins):
+    """Same counts as `np.histogram(values, bins)[0]` for increasing 1-D `bins`,
+    without the argument handling np.histogram does on every call.
+    Like np.histogram, the values are sorted and the edges are searched in
+    them, which is far cheaper than searching every value among the edges.
+    Returns the counts and the sorted values.
+    """
+    sorted_values = np.sort(values)
+    # np.histogram closes the last bin on the right.
+    cum = np.concatenate((sorted_values.searchsorted(bins[:-1], 'left'),
+                          sorted_values.searchsorted(bins[-1:], 'right')))
+    return np.diff(cum), sorted_values
 
 
 def image(tag, tensor):
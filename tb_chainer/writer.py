@@ -18,20 +18,140 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import time
 import json
 import os
 import re
+import struct
 import numpy as np
+import six
 import chainer
 import chainer.computational_graph as c
 from .src import event_pb2
 from .src import summary_pb2
 from .src import graph_pb2
-from .event_file_writer import EventFileWriter
+from .event_file_writer import EventFileWriter, directory_check
 from .summary import scalar, histogram, image, audio, text, video
 from .graph import graph, NodeName
 from .utils import make_grid
+try:
+    from orjson import dumps as _json_dumps
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+
+# os.replace() is missing on Python 2, where os.rename() overwrites the
+# target atomically on POSIX as well.
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _encode_varint(value):
+    """Encodes a non-negative integer as a protobuf base 128 varint."""
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _serialize_summary_event(summary_str, wall_time, step):
+    """Builds the wire format of an `Event` wrapping an already serialized
+    `Summary`, without parsing it.
+    The fields are written in field-number order, as `SerializeToString` does:
+    wall_time (1, fixed64), step (2, varint) and summary (5, length-delimited).
+    """
+    parts = [b'\x09', struct.pack('<d', wall_time)]
+    if step:
+        # int64 fields encode negative values as their 64-bit two's complement.
+        parts += [b'\x10', _encode_varint(step & 0xffffffffffffffff)]
+    parts += [b'\x2a', _encode_varint(len(summary_str)), summary_str]
+    return b''.join(parts)
+
+
+def _unzip(pairs):
+    """Splits a list of pairs into two lists."""
+    return [a for a, _ in pairs], [b for _, b in pairs]
+
+
+# Non-blocking copy stream of each device, keyed by device id.
+_copy_streams = {}
+# Whether ndarray.get() takes ``out``, which it only does since CuPy v8.
+# Cleared on the first TypeError so older versions are tried only once.
+_get_takes_out = True
+
+
+def _copy_stream(device):
+    """Returns the copy stream of `device`, made to wait for the work queued
+    so far on the null stream, where Chainer runs the forward pass and the
+    optimizer updates."""
+    stream = _copy_streams.get(device.id)
+    if stream is None:
+        stream = chainer.cuda.Stream(non_blocking=True)
+        _copy_streams[device.id] = stream
+    stream.wait_event(chainer.cuda.Stream.null.record())
+    return stream
+
+
+def _to_cpu_all(arrays, keys=None, host_buffers=None):
+    """Copies arrays to host memory, issuing every device-to-host transfer
+    before waiting for any of them.
+    GPU arrays are copied asynchronously on one non-blocking stream per device
+    and each stream is synchronized once at the end, instead of blocking on
+    every array in turn. NumPy arrays are passed through untouched.
+    If `host_buffers` is given, GPU arrays are copied into pinned buffers kept
+    in that dict under the matching entry of `keys` and reused by later calls,
+    so the returned arrays are only valid until the next call.
+    """
+    global _get_takes_out
+    ndarray = np.ndarray
+    if not chainer.cuda.available:
+        return [a if type(a) is ndarray else chainer.cuda.to_cpu(a)
+                for a in arrays]
+    if keys is None:
+        keys = [None] * len(arrays)
+    streams = {}
+    datas = []
+    for key, a in zip(keys, arrays):
+        if type(a) is ndarray:
+            datas.append(a)
+        elif isinstance(a, chainer.cuda.ndarray):
+            device = a.device
+            if device.id not in streams:
+                with device:
+                    streams[device.id] = _copy_stream(device)
+            stream = streams[device.id]
+            if host_buffers is not None and _get_takes_out and a.size > 0:
+                out = _pinned_buffer(host_buffers, key, a.shape, a.dtype)
+                try:
+                    with device:
+                        a.get(stream=stream, out=out)
+                    datas.append(out)
+                    continue
+                except TypeError:
+                    _get_takes_out = False
+                    host_buffers.clear()
+            datas.append(chainer.cuda.to_cpu(a, stream))
+        else:
+            datas.append(chainer.cuda.to_cpu(a))
+    for stream in streams.values():
+        stream.synchronize()
+    return datas
+
+
+def _pinned_buffer(host_buffers, key, shape, dtype):
+    """Returns the pinned host array cached under `key`, allocating a new one
+    if there is none yet or its shape or dtype changed."""
+    buf = host_buffers.get(key)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        mem = chainer.cuda.cupy.cuda.alloc_pinned_memory(size * dtype.itemsize)
+        buf = np.frombuffer(mem, dtype, size).reshape(shape)
+        host_buffers[key] = buf
+    return buf
 
 
 class SummaryToEventTransformer(object):
@@ -41,6 +161,7 @@ class SummaryToEventTransformer(object):
     passed to the contained event_writer.
     @@__init__
     @@add_summary
+    @@add_summaries
     @@add_session_log
     @@add_graph
     @@add_meta_graph
@@ -66,13 +187,16 @@ class SummaryToEventTransformer(object):
         writer = tf.summary.FileWriter(<some-directory>, sess.graph)
         ```
         Args:
-          event_writer: An EventWriter. Implements add_event method.
+          event_writer: An EventWriter. Implements add_event and add_event_bytes
+            methods.
           graph: A `Graph` object, such as `sess.graph`.
           graph_def: DEPRECATED: Use the `graph` argument instead.
         """
         self.event_writer = event_writer
         # For storing used tags for session.run() outputs.
         self._session_run_tags = {}
+        # Recycled `Event` protos, see _get_event() and _add_event().
+        self._event_pool = collections.deque(maxlen=64)
         # TODO(zihaolucky). pass this an empty graph to check whether it's necessary.
         # currently we don't support graph in MXNet using tensorboard.
 
@@ -91,17 +215,27 @@ class SummaryToEventTransformer(object):
           global_step: Number. Optional global step value to record with the
             summary.
         """
-        if isinstance(summary, bytes):
-            summ = summary_pb2.Summary()
-            summ.ParseFromString(summary)
-            summary = summ
-        event = event_pb2.Event(summary=summary)
-        self._add_event(event, global_step)
+        self._add_summary(summary, global_step, time.time())
+
+    def add_summaries(self, summaries, global_step=None):
+        """Adds several `Summary` protocol buffers to the event file.
+        Equivalent to calling `add_summary()` on each of them, except that all
+        the events share a single wall time.
+        Args:
+          summaries: An iterable of `Summary` protocol buffers, each optionally
+            serialized as a string.
+          global_step: Number. Optional global step value to record with the
+            summaries.
+        """
+        now = time.time()
+        for summary in summaries:
+            self._add_summary(summary, global_step, now)
 
     def add_graph(self, graph):
         """Adds a `Graph` protocol buffer to the event file.
         """
-        event = event_pb2.Event(graph_def=graph.SerializeToString())
+        event = self._get_event()
+        event.graph_def = graph.SerializeToString()
         self._add_event(event, None)
 
     def add_session_log(self, session_log, global_step=None):
@@ -113,14 +247,42 @@ class SummaryToEventTransformer(object):
           global_step: Number. Optional global step value to record with the
             summary.
         """
-        event = event_pb2.Event(session_log=session_log)
+        event = self._get_event()
+        event.session_log.CopyFrom(session_log)
         self._add_event(event, global_step)
 
+    def _get_event(self):
+        """Returns a cleared `Event` from the pool, or a new one if it is empty."""
+        try:
+            event = self._event_pool.pop()
+        except IndexError:
+            return event_pb2.Event()
+        event.Clear()
+        return event
+
+    def _add_summary(self, summary, step, now):
+        if isinstance(summary, bytes):
+            # Embed the serialized summary as is rather than parsing it only
+            # to serialize it again.
+            step = int(step) if step is not None else 0
+            self.event_writer.add_event_bytes(
+                _serialize_summary_event(summary, now, step))
+            return
+        event = self._get_event()
+        event.summary.CopyFrom(summary)
+        self._write_event(event, step, now)
+
     def _add_event(self, event, step):
-        event.wall_time = time.time()
+        self._write_event(event, step, time.time())
+
+    def _write_event(self, event, step, now):
+        event.wall_time = now
         if step is not None:
             event.step = int(step)
-        self.event_writer.add_event(event)
+        # Serialize here so only immutable bytes cross over to the writer
+        # thread, and the message can be reused by the next call.
+        self.event_writer.add_event_bytes(event.SerializeToString())
+        self._event_pool.append(event)
 
 
 class FileWriter(SummaryToEventTransformer):
@@ -146,7 +308,8 @@ class FileWriter(SummaryToEventTransformer):
                  graph=None,
                  max_queue=10,
                  flush_secs=120,
-                 graph_def=None):
+                 graph_def=None,
+                 buffer_size=65536):
         """Creates a `FileWriter` and an event file.
         On construction the summary writer creates a new event file in `logdir`.
         This event file will contain `Event` protocol buffers constructed when you
@@ -170,6 +333,8 @@ class FileWriter(SummaryToEventTransformer):
            and events to disk.
         *  `max_queue`: Maximum number of summaries or events pending to be
            written to disk before one of the 'add' calls block.
+        *  `buffer_size`: Size in bytes of the file buffer in which events are
+           batched between flushes.
         Args:
           logdir: A string. Directory where event file will be written.
           graph: A `Graph` object, such as `sess.graph`.
@@ -177,8 +342,10 @@ class FileWriter(SummaryToEventTransformer):
           flush_secs: Number. How often, in seconds, to flush the
             pending events and summaries to disk.
           graph_def: DEPRECATED: Use the `graph` argument instead.
+          buffer_size: Integer. Size in bytes of the event file buffer.
         """
-        event_writer = EventFileWriter(logdir, max_queue, flush_secs)
+        event_writer = EventFileWriter(logdir, max_queue, flush_secs,
+                                       buffer_size)
         super(FileWriter, self).__init__(event_writer, graph, graph_def)
 
     def get_logdir(self):
@@ -222,7 +389,10 @@ class SummaryWriter(object):
     to add data to the file directly from the training loop, without slowing down
     training.
     """
-    def __init__(self, logdir=None, comment=''):
+    _default_bins = None
+    _default_bins_f64 = None
+
+    def __init__(self, logdir=None, comment='', flush_secs=2):
         if not logdir:
             import socket
             from datetime import datetime
@@ -230,23 +400,58 @@ class SummaryWriter(object):
             logdir = os.path.join(
                 'runs', current_time + '_' + socket.gethostname() + comment)
 
-        self.file_writer = FileWriter(logdir=logdir)
-        v = 1E-12
-        buckets = []
-        neg_buckets = []
-        while v < 1E20:
-            buckets.append(v)
-            neg_buckets.append(-v)
-            v *= 1.1
-        self.default_bins = neg_buckets[::-1] + [0] + buckets
+        # Events are buffered, so keep the flush interval short enough for
+        # TensorBoard to follow training as it runs.
+        self.file_writer = FileWriter(logdir=logdir, flush_secs=flush_secs)
         self.text_tags = []
+        # Pinned host buffers for the parameter copies made by
+        # add_all_parameter_histograms, keyed by tag name. Parameters keep
+        # their shapes, so this stays bounded by the size of the model.
+        self._pinned_host_cache = {}
+        # (name, Parameter) pairs recorded by warmup(), and their subsets
+        # matching each pattern passed to add_all_parameter_histograms.
+        self._parameter_cache = None
+        self._parameter_matches = {}
+        self._text_tags_set = set()
+        self._text_dir_ready = False
+
+    @classmethod
+    def _get_default_bins(cls, dtype=np.float32):
+        """Returns the tensorflow-style bins, built once and shared by all writers.
+        The bins are float32 unless `dtype` is another type, in which case the
+        float64 copy is returned, so float32 values are binned without being
+        upcast.
+        """
+        if cls._default_bins is None:
+            # Same edges as tensorflow's histogram.cc: 1e-12 * 1.1**k below 1e20.
+            num = int(np.ceil(np.log(1E20 / 1E-12) / np.log(1.1)))
+            buckets = 1E-12 * np.power(1.1, np.arange(num, dtype=np.float64))
+            cls._default_bins_f64 = np.concatenate([-buckets[::-1], [0.0], buckets])
+            cls._default_bins = cls._default_bins_f64.astype(np.float32)
+        if dtype == np.float32:
+            return cls._default_bins
+        return cls._default_bins_f64
+
+    @property
+    def default_bins(self):
+        return self._get_default_bins()
+
+    @property
+    def default_bins_f64(self):
+        return self._get_default_bins(np.float64)
+
     def add_scalar(self, name, scalar_value, global_step=None):
         self.file_writer.add_summary(scalar(name, scalar_value), global_step)
 
     def add_histogram(self, name, values, global_step=None, bins='tensorflow'):
-        if bins=='tensorflow':
-            bins = self.default_bins
-        self.file_writer.add_summary(histogram(name, values, bins), global_step)
+        self.file_writer.add_summary(
+            self._histogram_summary(name, values, bins), global_step)
+
+    def _histogram_summary(self, name, values, bins='tensorflow'):
+        if isinstance(bins, six.string_types) and bins == 'tensorflow':
+            bins = type(self)._get_default_bins(values.dtype)
+        sorted_bins = bins is self._default_bins or bins is self._default_bins_f64
+        return histogram(name, values, bins, sorted_bins=sorted_bins)
 
     def add_image(self, tag, img_tensor, global_step=None):
         self.file_writer.add_summary(image(tag, img_tensor), global_step)
@@ -256,49 +461,100 @@ class SummaryWriter(object):
         self.file_writer.add_summary(video(tag, vid_tensor, fps), global_step)
     def add_text(self, tag, text_string, global_step=None):
         self.file_writer.add_summary(text(tag, text_string), global_step)
-        if tag not in self.text_tags:
+        if tag not in self._text_tags_set:
+            self._text_tags_set.add(tag)
             self.text_tags.append(tag)
             extensionDIR = self.file_writer.get_logdir()+'/plugins/tensorboard_text/'
-            if not os.path.exists(extensionDIR):
-                os.makedirs(extensionDIR)
-            with open(extensionDIR + 'tensors.json', 'w') as fp:
-                json.dump(self.text_tags, fp)
+            if not self._text_dir_ready:
+                directory_check(extensionDIR)
+                self._text_dir_ready = True
+            # Write a new file and move it into place, so that TensorBoard
+            # never reads a partly written tensors.json.
+            with open(extensionDIR + 'tensors.json.tmp', 'wb') as fp:
+                fp.write(_json_dumps(self.text_tags))
+            _replace(extensionDIR + 'tensors.json.tmp',
+                     extensionDIR + 'tensors.json')
     def add_graph(self, last_var):
         self.file_writer.add_graph(graph(last_var))
 
+    def warmup(self, last_var):
+        """Caches the parameters in the graph of `last_var` and their names.
+        Later `add_all_parameter_histograms` calls walk this list instead of
+        rebuilding the computational graph, and ignore their `last_var`.
+        Call it again if the set of parameters changes, or call
+        `warmup(None)` to drop the cache and walk `last_var` again.
+        """
+        if last_var is None:
+            self._parameter_cache = None
+            self._parameter_matches = {}
+            return
+        parameter = chainer.Parameter
+        variables = [(name, n._variable())
+                     for name, n in self._match_variable_nodes(last_var, '.*')]
+        self._parameter_cache = [(name, v) for name, v in variables
+                                 if isinstance(v, parameter)]
+        self._parameter_matches = {}
+
     def add_all_parameter_histograms(self, last_var, global_step=None, pattern='.*'):
-        cp = re.compile(pattern)
-        g = c.build_computational_graph(last_var)
-        names = NodeName(g.nodes)
-        for n in g.nodes:
-            if isinstance(n, chainer.variable.VariableNode) and \
-               isinstance(n._variable(), chainer.Parameter) and \
-               cp.match(names.name(n)):
-                data = chainer.cuda.to_cpu(n._variable().data)
-                self.add_histogram(names.name(n), data, global_step)
+        parameter = chainer.Parameter
+        # Filter the graph, copy every match to the host, then emit, one
+        # phase at a time.
+        if self._parameter_cache is not None:
+            params = self._parameter_matches.get(pattern)
+            if params is None:
+                cp = re.compile(pattern)
+                params = [(name, p) for name, p in self._parameter_cache
+                          if cp.match(name)]
+                self._parameter_matches[pattern] = params
+        else:
+            variables = [(name, n._variable())
+                         for name, n in self._match_variable_nodes(last_var, pattern)]
+            params = [(name, v) for name, v in variables if isinstance(v, parameter)]
+        names, arrays = _unzip([(name, p.data) for name, p in params])
+        datas = _to_cpu_all(arrays, names, self._pinned_host_cache)
+        self.file_writer.add_summaries(
+            [self._histogram_summary(name, data) for name, data in zip(names, datas)],
+            global_step)
 
     def add_all_variable_images(self, last_var, exclude_params=True, global_step=None, pattern='.*'):
+        parameter = chainer.Parameter
+        nodes = [(name, n) for name, n in self._match_variable_nodes(last_var, pattern)
+                 if n.data is not None]
+        names, arrays = _unzip([(name, n.data) for name, n in nodes
+                                if exclude_params and not isinstance(n._variable(), parameter)])
+        for data in arrays:
+            assert data.ndim < 5, "'variable.data' must be less than 5. the given 'variable.data.ndim' is %d." % data.ndim
+        datas = _to_cpu_all(arrays)
+        summaries = []
+        for name, data in zip(names, datas):
+            if data.ndim == 4:
+                # Non-RGB samples are shown as a grid of their channels;
+                # ``d[:, None]`` is a view, so no sample is copied here.
+                needs_expand = data.shape[1] != 3
+                for i, d in enumerate(data):
+                    img = make_grid(d[:, None] if needs_expand else d)
+                    summaries.append(image(name + '/' + str(i), img))
+            else:
+                img = make_grid(data[:, None] if data.shape[0] != 3 else data)
+                summaries.append(image(name, img))
+        self.file_writer.add_summaries(summaries, global_step)
+
+    def _match_variable_nodes(self, last_var, pattern):
+        """Returns `(name, node)` for every `VariableNode` in the graph of
+        `last_var` whose name matches `pattern`."""
         cp = re.compile(pattern)
         g = c.build_computational_graph(last_var)
         names = NodeName(g.nodes)
-        for n in g.nodes:
-            if isinstance(n, chainer.variable.VariableNode) and \
-               (exclude_params and not isinstance(n._variable(), chainer.Parameter)) and \
-               n.data is not None and \
-               cp.match(names.name(n)):
-                data = chainer.cuda.to_cpu(n.data)
-                assert data.ndim < 5, "'variable.data' must be less than 5. the given 'variable.data.ndim' is %d." % data.ndim
-                if data.ndim == 4:
-                    for i, d in enumerate(data):
-                        img = make_grid(np.expand_dims(d, 1) if d.shape[0] != 3 else d)
-                        self.add_image(names.name(n) + '/' + str(i), img, global_step)
-                else:
-                    img = make_grid(np.expand_dims(data, 1) if data.shape[0] != 3 else data)
-                    self.add_image(names.name(n), img, global_step)
+        variable_node = chainer.variable.VariableNode
+        named = [(names.name(n), n) for n in g.nodes if type(n) is variable_node]
+        return [(name, n) for name, n in named if cp.match(name)]
 
     def close(self):
-        self.file_writer.flush()
+        # FileWriter.close() already flushes the pending events. It does
+        # nothing on a closed writer, so repeated calls and __del__ are safe,
+        # and events added after close() are dropped as before.
         self.file_writer.close()
+        self._pinned_host_cache.clear()
 
     def __del__(self):
         if self.file_writer is not None:
@@ -21,3 +21,175 @@ def test_name_scope():
     assert y.node.name_scope == "test"
     assert x.node.name_scope == "test"
     assert not hasattr(z, "name_scope")
+
+def test_serialize_summary_event():
+    from tb_chainer.writer import _serialize_summary_event
+    from tb_chainer.summary import scalar
+    from tb_chainer.src import event_pb2
+    summary = scalar('loss', 0.5)
+    for step in [0, 1, 300, -2]:
+        expected = event_pb2.Event(wall_time=12.5, step=step, summary=summary)
+        event_str = _serialize_summary_event(summary.SerializeToString(), 12.5, step)
+        assert event_str == expected.SerializeToString()
+
+def test_bucketize():
+    import numpy as np
+    from tb_chainer.summary import _bucketize
+    bins = np.array([-1.0, 0.0, 0.5, 2.0])
+    values = np.array([-3.0, -1.0, -0.5, 0.0, 0.5, 1.0, 2.0, 2.0, 5.0])
+    counts, sorted_values = _bucketize(values, bins)
+    assert np.array_equal(counts, np.histogram(values, bins)[0])
+    assert np.array_equal(sorted_values, np.sort(values))
+
+def test_make_histogram_sorted_bins():
+    import numpy as np
+    import pytest
+    from tb_chainer.summary import make_histogram
+    bins = np.array([-1.0, 0.0, 0.5, 2.0])
+    for values in [np.array([1.0, -0.5, 3.0]), np.array([1.0, np.nan, -2.0])]:
+        fast = make_histogram(values, bins, sorted_bins=True)
+        slow = make_histogram(values, bins)
+        assert list(fast.bucket) == list(slow.bucket)
+        np.testing.assert_array_equal([fast.min, fast.max], [slow.min, slow.max])
+    assert np.isnan(fast.min) and np.isnan(fast.max)
+    for sorted_bins in [True, False]:
+        with pytest.raises(ValueError):
+            make_histogram(np.array([]), bins, sorted_bins=sorted_bins)
+
+def test_to_cpu_all_pinned_fallback(monkeypatch):
+    import chainer
+    import numpy as np
+    from tb_chainer import writer
+
+    class FakeDevice(object):
+        id = 0
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            pass
+
+    class FakeStream(object):
+        def __init__(self, non_blocking=False):
+            pass
+        def record(self):
+            return None
+        def wait_event(self, event):
+            pass
+        def synchronize(self):
+            pass
+    FakeStream.null = FakeStream()
+
+    class FakeArray(object):
+        # Mimics a CuPy array whose get() predates the ``out`` argument.
+        device = FakeDevice()
+        calls = 0
+        def __init__(self, data):
+            self.data = data
+            self.size, self.shape, self.dtype = data.size, data.shape, data.dtype
+        def get(self, stream=None, out=None):
+            FakeArray.calls += 1
+            if out is not None:
+                raise TypeError('out')
+            return self.data.copy()
+
+    allocated = []
+    def pinned_buffer(host_buffers, key, shape, dtype):
+        allocated.append(key)
+        host_buffers[key] = np.empty(shape, dtype)
+        return host_buffers[key]
+
+    monkeypatch.setattr(chainer.cuda, 'available', True)
+    monkeypatch.setattr(chainer.cuda, 'ndarray', FakeArray)
+    monkeypatch.setattr(chainer.cuda, 'Stream', FakeStream)
+    monkeypatch.setattr(chainer.cuda, 'to_cpu', lambda a, stream=None: a.get(stream))
+    monkeypatch.setattr(writer, '_pinned_buffer', pinned_buffer)
+    monkeypatch.setattr(writer, '_copy_streams', {})
+    monkeypatch.setattr(writer, '_get_takes_out', True)
+
+    host = np.arange(3.0)
+    arrays = [FakeArray(np.arange(4.0)), host, FakeArray(np.ones((2, 2)))]
+    cache = {}
+    for _ in range(2):
+        datas = writer._to_cpu_all(arrays, ['a', 'b', 'c'], cache)
+        assert datas[1] is host
+        np.testing.assert_array_equal(datas[0], np.arange(4.0))
+        np.testing.assert_array_equal(datas[2], np.ones((2, 2)))
+    # Only the first copy tries ``out``; later ones go straight to to_cpu.
+    assert allocated == ['a']
+    assert FakeArray.calls == 5
+    assert cache == {}
+
+def test_warmup_parameter_histograms():
+    import chainer
+    import numpy as np
+    from tb_chainer import SummaryWriter
+
+    # A single link, so that no two parameters share a name; the numeric
+    # suffixes of shared names depend on the walk order.
+    model = chainer.links.Linear(3, 4)
+    x = np.ones((2, 3), dtype=np.float32)
+
+    def emit(writer, step):
+        emitted = []
+        writer.file_writer.add_summaries = lambda summaries, global_step: \
+            emitted.extend(s.SerializeToString() for s in summaries)
+        writer.add_all_parameter_histograms([model(x)], global_step=step)
+        # The graph is walked in no particular order.
+        return sorted(emitted)
+
+    writer = SummaryWriter('runs/test_warmup')
+    uncached = emit(writer, 0)
+    writer.warmup([model(x)])
+    assert emit(writer, 0) == uncached
+    # Values are read from the parameters on every call.
+    model.W.array += 1
+    cached = emit(writer, 1)
+    writer.warmup(None)
+    assert emit(writer, 1) == cached != uncached
+    writer.close()
+
+def test_add_summaries():
+    from tb_chainer.writer import SummaryToEventTransformer
+    from tb_chainer.summary import scalar
+    from tb_chainer.src import event_pb2
+
+    class EventWriter(object):
+        def __init__(self):
+            self.events = []
+        def add_event_bytes(self, event_str):
+            self.events.append(event_pb2.Event.FromString(event_str))
+
+    summaries = [scalar('a', 1.0), scalar('b', 2.0).SerializeToString(), scalar('c', 3.0)]
+    for step in [None, 5]:
+        writer = EventWriter()
+        SummaryToEventTransformer(writer).add_summaries(summaries, step)
+        assert [e.summary.value[0].tag for e in writer.events] == ['a', 'b', 'c']
+        assert [e.summary.value[0].simple_value for e in writer.events] == [1.0, 2.0, 3.0]
+        assert len(set(e.wall_time for e in writer.events)) == 1
+        assert all(e.step == (step or 0) for e in writer.events)
+
+def test_events_written_without_close(tmpdir):
+    import glob
+    import os
+    import struct
+    import subprocess
+    import sys
+    script = '\n'.join([
+        'from tb_chainer import SummaryWriter',
+        'writer = SummaryWriter(%r)' % str(tmpdir),
+        'for i in range(100):',
+        '    writer.add_scalar("x", i, i)',
+        # Keep __del__ from closing the writer before interpreter shutdown.
+        'writer.cycle = writer',
+    ])
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.check_call([sys.executable, '-c', script], cwd=root)
+    data = open(glob.glob(str(tmpdir.join('events*')))[0], 'rb').read()
+    records = offset = 0
+    while offset < len(data):
+        length, = struct.unpack('<Q', data[offset:offset + 8])
+        # length, its crc, the data and its crc.
+        offset += 8 + 4 + length + 4
+        records += 1
+    # The file version event and the 100 scalars.
+    assert records == 101 and offset == len(data)